@@ -0,0 +1,104 @@
+"""How long the main thread is blocked delivering results
+
+A background thread completes COUNT fake fetches through a real reader,
+calling _URLReader.deliverHandle_url_data_error_ with a URLReaderHandle
+for each of them like the NSURLSession completion handler does. The
+reader either dispatches each result to the main thread on its own, by
+default, or in batches, like URLReader(batch_size=...) does.
+
+Once the background thread has finished, the main run loop runs in short
+slices until every result has been delivered. We time each slice that
+delivered anything, run loop overhead included, and report how many
+main thread hops there were, how long the main thread was blocked in
+total and how long the longest slice blocked it.
+"""
+import time
+import threading
+
+import objc
+
+from Foundation import NSRunLoop, NSDate, NSURL, NSData
+
+from urlreader import URLReader, URLReaderHandle
+
+
+COUNT = 5000
+
+
+class Results(object):
+
+    def __init__(self):
+        self.delivered = 0
+        self.hops = 0
+
+    def callback(self, url, data, error):
+        self.delivered += 1
+
+
+def complete_in_background(reader, handles):
+    url = NSURL.URLWithString_('http://example.org/')
+    data = NSData.data()
+
+    def complete():
+        with objc.autorelease_pool():
+            for handle in handles:
+                reader._reader.deliverHandle_url_data_error_(
+                    handle, url, data, None)
+
+    thread = threading.Thread(target=complete)
+    thread.start()
+    thread.join()
+
+
+def drain(results):
+    slices = []
+    runLoop = NSRunLoop.mainRunLoop()
+    while results.delivered < COUNT:
+        delivered = results.delivered
+        start = time.perf_counter()
+        runLoop.runUntilDate_(NSDate.date())
+        elapsed = time.perf_counter() - start
+        if results.delivered != delivered:
+            slices.append(elapsed)
+    return slices
+
+
+def run(results, **kwargs):
+    with URLReader(**kwargs) as reader:
+        handles = [
+            URLReaderHandle(reader, f'http://example.org/{i}',
+                            results.callback)
+            for i in range(COUNT)
+        ]
+        complete_in_background(reader, handles)
+        return drain(results)
+
+
+def per_item():
+    results = Results()
+    slices = run(results)
+    # every result is a hop of its own
+    results.hops = COUNT
+    return results, slices
+
+
+def batched(size):
+    results = Results()
+
+    def batch_callback(batch):
+        results.hops += 1
+
+    slices = run(results, batch_interval=0.05, batch_size=size,
+                 batch_callback=batch_callback)
+    return results, slices
+
+
+if __name__ == '__main__':
+    print(f'{COUNT} results')
+    runs = [('per item', per_item())]
+    for size in (10, 100, 1000):
+        runs.append((f'batches of {size}', batched(size)))
+    for name, (results, slices) in runs:
+        print(f'{name:>20}: {results.hops:5} hops, '
+              f'blocked {sum(slices) * 1000:8.2f}ms in total, '
+              f'longest slice {max(slices) * 1000:.3f}ms')
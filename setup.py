@@ -24,7 +24,7 @@ setuptools.setup(
         "Environment :: MacOS X :: Cocoa",
         "Topic :: Internet",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     install_requires=[
         'pyobjc>=5.2'
     ],
@@ -1,12 +1,20 @@
+import os
+import sys
 import time
 import unittest
+import subprocess
+
+import urlreader.nsurlsession
 
 from multiprocessing import Process
+from socketserver import ThreadingMixIn
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
 from Foundation import NSThread, NSMutableData
 
-from urlreader import URLReader, URLReaderError
+from urlreader import URLReader, URLReaderError, TIMEOUT_ERROR_KEY
+from urlreader.batching import Batcher
+from urlreader.resolver import DNSCache
 from urlreader.utils import decode_data
 
 
@@ -32,6 +40,17 @@ class MockServer(BaseHTTPRequestHandler):
             self.end_headers()
             return
 
+        if self.path == '/redirect/bogus':
+            self.send_response(301)
+            self.send_header(
+                "Location", "http://www.doesnot-exist.forsure-xxx/")
+            self.end_headers()
+            return
+
+        if self.path == '/slow/headers':
+            # the server takes its time before responding at all
+            time.sleep(2)
+
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         # cache for one hour
@@ -40,9 +59,19 @@ class MockServer(BaseHTTPRequestHandler):
 
         if self.path == '/':
             self.wfile.write(b'Hello, world')
-        elif self.path == '/slow':
+        elif self.path in ('/slow', '/slow/headers'):
             time.sleep(2)
             self.wfile.write(b'Slow response')
+        elif self.path == '/slow/stall':
+            # the first bytes arrive right away, then nothing for a while
+            self.wfile.write(b'Slow ')
+            time.sleep(2)
+            self.wfile.write(b'response')
+        elif self.path == '/slow/trickle':
+            # never idle for long, but it takes a while overall
+            for _ in range(20):
+                self.wfile.write(b'.')
+                time.sleep(0.1)
         elif self.path == '/count/reset':
             MockServer.count = 0
             self.wfile.write(f'{MockServer.count}'.encode('utf-8'))
@@ -63,6 +92,13 @@ class MockServer(BaseHTTPRequestHandler):
     def log_message(self, *args): pass
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    """Serves each request in its own thread, so slow ones don’t block"""
+
+    daemon_threads = True
+
+
 class MockServerTest(unittest.TestCase):
 
     server = None
@@ -72,7 +108,7 @@ class MockServerTest(unittest.TestCase):
         # make an HTTP server and run it in another process
         def run_test_http_server():
             server_address = (MOCK_SERVER_ADDRESS, MOCK_SERVER_PORT)
-            httpd = HTTPServer(server_address, MockServer)
+            httpd = ThreadingHTTPServer(server_address, MockServer)
             httpd.serve_forever()
 
         cls.server = Process(target=run_test_http_server)
@@ -151,6 +187,55 @@ class URLReaderTest(MockServerTest):
         reader = URLReader(timeout=0.2, wait_until_done=True)
         reader.fetch(MOCK_SERVER_URL + '/slow', callback)
 
+    def assertTimedOut(self, data, error, timeout=None):
+        self.assertEqual(data, None)
+        self.assertEqual(error.code(), -1001)
+        if timeout is not None:
+            self.assertEqual(error.userInfo()[TIMEOUT_ERROR_KEY], timeout)
+
+    def test_response_timeout(self):
+        def callback(url, data, error):
+            self.assertTimedOut(data, error, 'response')
+            self.assertEqual(error.localizedDescription(),
+                             'The server took too long to respond.')
+
+        reader = URLReader(response_timeout=0.2, wait_until_done=True)
+        reader.fetch(MOCK_SERVER_URL + '/slow/headers', callback)
+
+    def test_body_timeout(self):
+        def callback(url, data, error):
+            self.assertTimedOut(data, error, 'body')
+
+        # the headers arrive right away, so the response timeout is met
+        reader = URLReader(
+            response_timeout=1, body_timeout=0.2, wait_until_done=True)
+        reader.fetch(MOCK_SERVER_URL + '/slow', callback)
+
+    def test_idle_timeout(self):
+        def callback(url, data, error):
+            self.assertTimedOut(data, error)
+
+        # the first bytes arrive right away, then the response stalls
+        reader = URLReader(body_timeout=1, wait_until_done=True)
+        reader.fetch(MOCK_SERVER_URL + '/slow/stall', callback,
+                     idle_timeout=0.5)
+
+    def test_idle_timeout_not_hit_by_trickle(self):
+        def callback(url, data, error):
+            self.assertEqual(error, None)
+            self.assertEqual(len(data), 20)
+
+        reader = URLReader(idle_timeout=0.5, wait_until_done=True)
+        reader.fetch(MOCK_SERVER_URL + '/slow/trickle', callback)
+
+    def test_total_timeout(self):
+        def callback(url, data, error):
+            self.assertTimedOut(data, error, 'total')
+
+        # never idle for longer than the idle timeout, but over the deadline
+        reader = URLReader(idle_timeout=0.5, wait_until_done=True)
+        reader.fetch(MOCK_SERVER_URL + '/slow/trickle', callback, timeout=0.5)
+
     def test_multiple_urls(self):
         def callback(url, data, error):
             self._multiple_urls_data.appendData_(data)
@@ -186,6 +271,234 @@ class URLReaderTest(MockServerTest):
         while not reader.done:
             reader.continue_runloop()
 
+    def test_timings(self):
+        reader = URLReader(wait_until_done=True)
+        reader.fetch(MOCK_SERVER_URL + '/hello/Timings',
+                     lambda url, data, error: None)
+        timings = reader.timings_for_url(MOCK_SERVER_URL + '/hello/Timings')
+        self.assertTrue(timings['total'] >= 0)
+        self.assertTrue('domain_lookup' in timings)
+        self.assertTrue('connect' in timings)
+
+    def test_timings_capacity(self):
+        capacity = urlreader.nsurlsession.TIMINGS_CAPACITY
+        urlreader.nsurlsession.TIMINGS_CAPACITY = 2
+        try:
+            reader = URLReader(wait_until_done=True)
+            for name in 'ABC':
+                reader.fetch(MOCK_SERVER_URL + f'/hello/{name}',
+                             lambda url, data, error: None)
+            # only the last two are kept
+            self.assertEqual(
+                reader.timings_for_url(MOCK_SERVER_URL + '/hello/A'), None)
+            self.assertTrue(
+                reader.timings_for_url(MOCK_SERVER_URL + '/hello/C'))
+        finally:
+            urlreader.nsurlsession.TIMINGS_CAPACITY = capacity
+
+    def test_negative_dns_cache(self):
+        def callback(url, data, error):
+            # we never hit the network, the host is known not to resolve
+            self.assertEqual(data, None)
+            self.assertEqual(error.code(), -1003)
+
+        dns_cache = DNSCache()
+        dns_cache.set_failure('www.doesnot-exist.forsure-xxx')
+        reader = URLReader(dns_cache=dns_cache, wait_until_done=True)
+        reader.fetch('https://www.doesnot-exist.forsure-xxx/', callback)
+
+    def test_handle_result(self):
+        received = []
+        reader = URLReader()
+        handle = reader.fetch(
+            MOCK_SERVER_URL + '/hello/Handle',
+            lambda url, data, error: received.append(data))
+
+        url, data, error = handle.result(timeout=5)
+        self.assertTrue(handle.done())
+        self.assertFalse(handle.cancelled())
+        self.assertEqual(decode_data(data), 'Hello, Handle!')
+        self.assertEqual(handle.bytes_received, len('Hello, Handle!'))
+        # the callback has been called as well
+        self.assertEqual(received, [data])
+
+    def test_cancel(self):
+        def callback(url, data, error):
+            self.fail('the callback of a cancelled fetch was called')
+
+        reader = URLReader()
+        handle = reader.fetch(MOCK_SERVER_URL + '/slow', callback)
+        self.assertFalse(handle.done())
+        self.assertTrue(handle.cancel())
+
+        # the reader isn’t holding on to it anymore
+        self.assertTrue(reader.done)
+        self.assertTrue(handle.done())
+        self.assertTrue(handle.cancelled())
+        with self.assertRaises(URLReaderError):
+            handle.result()
+
+        # give the cancelled task a chance to complete
+        for _ in range(20):
+            reader.continue_runloop()
+
+    def test_shared_fetch(self):
+        received = []
+        url = MOCK_SERVER_URL + '/hello/Shared'
+
+        reader = URLReader()
+        first = reader.fetch(
+            url, lambda url, data, error: received.append('first'), tag='a')
+        second = reader.fetch(
+            url, lambda url, data, error: received.append('second'), tag='b')
+        third = reader.fetch(
+            url, lambda url, data, error: received.append('third'), tag='c')
+        # every caller gets its own handle
+        self.assertTrue(first is not second and second is not third)
+
+        # cancelling one of them doesn’t affect the others
+        self.assertTrue(first.cancel())
+        reader.cancel_all(tag='c')
+        self.assertFalse(reader.done)
+
+        self.assertEqual(
+            decode_data(second.result(timeout=5)[1]), 'Hello, Shared!')
+        self.assertEqual(received, ['second'])
+
+    def test_shared_fetch_cancelled(self):
+        url = MOCK_SERVER_URL + '/slow'
+
+        reader = URLReader()
+        first = reader.fetch(url, lambda url, data, error: None)
+        second = reader.fetch(url, lambda url, data, error: None)
+        first.cancel()
+        self.assertFalse(reader.done)
+        # the request goes when its last handle is cancelled
+        second.cancel()
+        self.assertTrue(reader.done)
+
+    def test_cancel_all_by_tag(self):
+        received = []
+
+        def callback(url, data, error):
+            received.append(decode_data(data))
+
+        reader = URLReader()
+        reader.fetch(MOCK_SERVER_URL + '/hello/A', callback, tag='keep')
+        reader.fetch(MOCK_SERVER_URL + '/slow', callback, tag='drop')
+        reader.fetch(MOCK_SERVER_URL + '/slow/stall', callback, tag='drop')
+        reader.cancel_all(tag='drop')
+        while not reader.done:
+            reader.continue_runloop()
+        for _ in range(20):
+            reader.continue_runloop()
+        self.assertEqual(received, ['Hello, A!'])
+
+        reader.fetch(MOCK_SERVER_URL + '/slow', callback)
+        reader.cancel_all()
+        self.assertTrue(reader.done)
+
+    def test_batch_callback(self):
+        batches = []
+        urls = [MOCK_SERVER_URL + f'/hello/{name}' for name in 'ABCDEF']
+
+        reader = URLReader(batch_interval=0.5, batch_callback=batches.append)
+        for url in urls:
+            reader.fetch(url, None)
+        while not reader.done:
+            reader.continue_runloop()
+
+        # everything arrived, in fewer main thread hops than results
+        results = [result for batch in batches for result in batch]
+        self.assertEqual(len(results), len(urls))
+        self.assertTrue(len(batches) < len(urls))
+        self.assertEqual(
+            sorted(decode_data(data) for url, data, error in results),
+            [f'Hello, {name}!' for name in 'ABCDEF'])
+
+    def test_batched_callbacks(self):
+        received = []
+
+        def callback(url, data, error):
+            # still called on the main thread, one by one
+            self.assertTrue(NSThread.currentThread().isMainThread())
+            received.append(decode_data(data))
+
+        reader = URLReader(batch_size=2, wait_until_done=True)
+        reader.fetch(MOCK_SERVER_URL + '/hello/A', callback)
+        # wait_until_done also waits for the batch to be delivered
+        self.assertEqual(received, ['Hello, A!'])
+
+    def test_close(self):
+        with URLReader(wait_until_done=True) as reader:
+            reader.fetch(MOCK_SERVER_URL, lambda url, data, error:
+                         self.assertEqual(decode_data(data), 'Hello, world'))
+        # the session is gone, along with its connections
+        self.assertEqual(reader._reader._session, None)
+        with self.assertRaises(URLReaderError):
+            reader.fetch(MOCK_SERVER_URL, lambda url, data, error: None)
+        # closing twice is fine
+        reader.close()
+
+    def test_negative_dns_cache_after_redirect(self):
+        def callback(url, data, error):
+            self.assertTrue(error is not None)
+
+        dns_cache = DNSCache()
+        reader = URLReader(dns_cache=dns_cache, wait_until_done=True)
+        reader.fetch(MOCK_SERVER_URL + '/redirect/bogus', callback)
+
+        # the host that didn’t resolve is the one we were redirected to...
+        self.assertTrue(
+            dns_cache.is_unresolvable('www.doesnot-exist.forsure-xxx'))
+        # ...so the one we asked for is still fine
+        self.assertFalse(dns_cache.is_unresolvable(MOCK_SERVER_ADDRESS))
+        reader.fetch(
+            MOCK_SERVER_URL + '/hello/A',
+            lambda url, data, error:
+            self.assertEqual('Hello, A!', decode_data(data)))
+
+    def test_batch_with_failing_callback(self):
+        received = []
+        batches = []
+
+        def callback(url, data, error):
+            if str(url).endswith('/B'):
+                raise ValueError('this callback is broken')
+            received.append(decode_data(data))
+
+        reader = URLReader(batch_size=3, batch_callback=batches.append)
+        handles = [reader.fetch(MOCK_SERVER_URL + f'/hello/{name}', callback)
+                   for name in 'ABC']
+        while not reader.done:
+            reader.continue_runloop()
+
+        # the other callbacks, handles and the batch callback still ran
+        self.assertEqual(sorted(received), ['Hello, A!', 'Hello, C!'])
+        self.assertTrue(all(handle.done() for handle in handles))
+        self.assertEqual(sum(len(batch) for batch in batches), 3)
+
+    def test_cancel_all_in_batch_window(self):
+        received = []
+
+        def callback(url, data, error):
+            received.append(decode_data(data))
+
+        reader = URLReader(batch_interval=0.5)
+        for name in 'ABC':
+            reader.fetch(MOCK_SERVER_URL + f'/hello/{name}', callback,
+                         tag='thumbnails')
+        reader.fetch(MOCK_SERVER_URL + '/hello/D', callback)
+
+        # the responses are in, but still waiting for the batch window
+        while reader._reader._fetches:
+            time.sleep(0.01)
+        reader.cancel_all(tag='thumbnails')
+
+        while not reader.done:
+            reader.continue_runloop()
+        self.assertEqual(received, ['Hello, D!'])
+
     def test_redirect(self):
         # yes, of course you can also use a lambda as the callback
         URLReader(wait_until_done=True).fetch(
@@ -315,6 +628,79 @@ class CachingURLReaderTest(MockServerTest):
         reader.flush_cache()
 
 
+class DNSCacheTest(unittest.TestCase):
+
+    """Negative DNS cache tests, using a fake clock"""
+
+    def setUp(self):
+        self.now = 0
+
+    def clock(self):
+        return self.now
+
+    def test_negative_ttl(self):
+        cache = DNSCache(negative_ttl=10, clock=self.clock)
+        self.assertFalse(cache.is_unresolvable('unresolvable.example.org'))
+
+        cache.set_failure('unresolvable.example.org')
+        self.assertTrue(cache.is_unresolvable('unresolvable.example.org'))
+        self.assertFalse(cache.is_unresolvable('example.org'))
+
+        # the failure expired, so the host gets another chance
+        self.now = 11
+        self.assertFalse(cache.is_unresolvable('unresolvable.example.org'))
+
+    def test_invalidate(self):
+        cache = DNSCache(clock=self.clock)
+        cache.set_failure('a.example.org')
+        cache.set_failure('b.example.org')
+
+        cache.invalidate('a.example.org')
+        self.assertFalse(cache.is_unresolvable('a.example.org'))
+        self.assertTrue(cache.is_unresolvable('b.example.org'))
+
+        cache.invalidate()
+        self.assertFalse(cache.is_unresolvable('b.example.org'))
+
+
+class BatcherTest(unittest.TestCase):
+
+    """Result batching tests, delivering on the calling thread"""
+
+    def setUp(self):
+        self.dispatched = []
+        self.delivered = []
+
+    def dispatch(self, deliver, batch):
+        self.dispatched.append(batch)
+        deliver(batch)
+
+    def test_size(self):
+        batcher = Batcher(self.dispatch, self.delivered.extend,
+                          interval=10, size=3)
+        for i in range(7):
+            batcher.add(i)
+        self.assertEqual(self.dispatched, [[0, 1, 2], [3, 4, 5]])
+        self.assertFalse(batcher.idle())
+
+        batcher.flush()
+        self.assertEqual(self.dispatched[-1], [6])
+        self.assertEqual(self.delivered, list(range(7)))
+        self.assertTrue(batcher.idle())
+
+    def test_interval(self):
+        batcher = Batcher(self.dispatch, self.delivered.extend,
+                          interval=0.1)
+        batcher.add(0)
+        batcher.add(1)
+        self.assertEqual(self.dispatched, [])
+
+        # the window closes and the whole batch goes at once
+        time.sleep(0.3)
+        self.assertEqual(self.dispatched, [[0, 1]])
+        self.assertTrue(batcher.idle())
+
+
 class OfflineURLReaderTest(unittest.TestCase):
 
     """Offline test suite
@@ -384,5 +770,38 @@ class OfflineURLReaderTest(unittest.TestCase):
         )
 
 
+class ImportTimeTest(unittest.TestCase):
+
+    """Importing urlreader must stay cheap for short-lived scripts"""
+
+    # in seconds, cumulative for the urlreader package
+    IMPORT_TIME_BUDGET = 0.1
+
+    def test_import_time(self):
+        # a fresh interpreter, since this one has Foundation loaded already
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import sys, urlreader; print("objc" in sys.modules)'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+
+        # importing the package doesn’t load PyObjC...
+        self.assertEqual(result.stdout.strip(), 'False')
+
+        # ...and fits in the budget
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:'):
+                continue
+            _, cumulative, package = line.split('|')
+            if package.strip() == 'urlreader':
+                cumulative = int(cumulative) / 1000000
+                self.assertLess(cumulative, self.IMPORT_TIME_BUDGET)
+                break
+        else:
+            self.fail('urlreader import time not found')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,31 +1,37 @@
 import re
-import objc
+import time
 import logging
 
 from urllib.parse import urlparse, urlunparse, quote
 
-from Foundation import NSObject, NSRunLoop, NSDate
-from Foundation import NSFileManager, NSCachesDirectory, NSUserDomainMask
-from Foundation import NSURL, NSURLSession, NSURLSessionConfiguration
-from Foundation import NSURLRequest, NSURLRequestUseProtocolCachePolicy
-from Foundation import NSURLRequestReturnCacheDataElseLoad, NSURLCache
-from Foundation import NSURLResponse, NSCachedURLResponse
 
-from PyObjCTools.AppHelper import callAfter
+logger = logging.getLogger('URLReader')
 
 
-logger = logging.getLogger('URLReader')
+quote_r = re.compile('%[A-Za-z0-9]{2}')
 
 
-USER_CACHE_DIRECTORY_URL, _ = NSFileManager.defaultManager().\
-    URLForDirectory_inDomain_appropriateForURL_create_error_(
-        NSCachesDirectory, NSUserDomainMask, None, True, None
-    )
-CACHE_DIRECTORY_URL = USER_CACHE_DIRECTORY_URL.\
-    URLByAppendingPathComponent_isDirectory_('URLReader', True)
+# the userInfo key of the timeout errors URLReader makes itself, with the
+# timeout that was hit: 'response', 'body' or 'total'
+TIMEOUT_ERROR_KEY = 'URLReaderTimeout'
 
 
-quote_r = re.compile('%[A-Za-z0-9]{2}')
+def __getattr__(name):
+    # PyObjC and Foundation are only loaded when they are first needed,
+    # so importing urlreader stays cheap for code that doesn’t use them
+    if name == 'USER_CACHE_DIRECTORY_URL':
+        from .nsurlsession import user_cache_directory_url
+        return user_cache_directory_url()
+    if name == 'CACHE_DIRECTORY_URL':
+        from .nsurlsession import cache_directory_url
+        return cache_directory_url()
+    if name == '_URLReader':
+        from .nsurlsession import _URLReader
+        return _URLReader
+    if name == 'DNSCache':
+        from .resolver import DNSCache
+        return DNSCache
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def callback(url, data, error):
@@ -43,6 +49,87 @@ class URLReaderError(Exception):
     pass
 
 
+class URLReaderHandle(object):
+    """A fetch in progress, as returned by URLReader.fetch()"""
+
+    def __init__(self, reader, url, callback, tag=None):
+        self.url = url
+        self.tag = tag
+        self._reader = reader
+        self._callback = callback
+        self._task = None
+        self._result = None
+        self._cancelled = False
+
+    def __repr__(self):
+        state = 'cancelled' if self._cancelled else \
+            'done' if self._result is not None else 'pending'
+        return f'<URLReaderHandle {self.url} {state}>'
+
+    @property
+    def bytes_received(self):
+        if self._task is not None:
+            return self._task.countOfBytesReceived()
+        if self._result is not None and self._result[1] is not None:
+            return len(self._result[1])
+        return 0
+
+    @property
+    def bytes_expected(self):
+        """The size of the response, or None if it’s not known yet"""
+        if self._task is not None:
+            expected = self._task.countOfBytesExpectedToReceive()
+            return expected if expected > 0 else None
+        if self._result is not None and self._result[1] is not None:
+            return len(self._result[1])
+        return None
+
+    def cancel(self):
+        """Stop the fetch, its callback won’t be called
+
+        Returns False if it was too late to cancel it.
+        """
+        if self.done():
+            return False
+        self._cancelled = True
+        self._reader._reader.cancelHandle_(self)
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._cancelled or self._result is not None
+
+    def result(self, timeout=None):
+        """Return the (url, data, error) the callback received
+
+        Runs the main run loop until the fetch is done, so it must be
+        called on the main thread. Raises URLReaderError if the fetch was
+        cancelled or isn’t done after `timeout` seconds.
+        """
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while not self.done():
+            if timeout is not None and time.monotonic() >= deadline:
+                raise URLReaderError(f'{self.url} is not done yet')
+            self._reader.continue_runloop()
+        if self._cancelled:
+            raise URLReaderError(f'{self.url} was cancelled')
+        return self._result
+
+    def _complete(self, url, data, error):
+        # called on the main thread, returns whether it was delivered
+        if self._cancelled:
+            return False
+        self._reader._reader.forgetHandle_(self)
+        self._result = (url, data, error)
+        self._task = None
+        if self._callback is not None:
+            self._callback(url, data, error)
+        return True
+
+
 class URLReader(object):
     """A wrapper around macOS’s NSURLSession, etc.
 
@@ -54,11 +141,31 @@ class URLReader(object):
     def __init__(self, timeout=10,
                  quote_url_path=True, force_https=False,
                  use_cache=False,
-                 cache_location=CACHE_DIRECTORY_URL,
-                 wait_until_done=False):
+                 cache_location=None,
+                 wait_until_done=False,
+                 dns_cache=None,
+                 response_timeout=None, body_timeout=None,
+                 idle_timeout=None,
+                 batch_interval=None, batch_size=None, batch_callback=None):
 
+        from .nsurlsession import _URLReader
+
+        self._closed = False
         self._reader = _URLReader.alloc().init()
         self._reader.setTimeout_(timeout)
+        self._reader.setIdleTimeout_(idle_timeout)
+        self._response_timeout = response_timeout
+        self._body_timeout = body_timeout
+        if dns_cache is not None:
+            # only its negative caching applies, NSURLSession resolves
+            # the hosts that aren’t known to fail by itself
+            self._reader.setDNSCache_(dns_cache)
+        self._batch_callback = batch_callback
+        if batch_interval is not None or batch_size is not None or \
+                batch_callback is not None:
+            self._reader.setBatchInterval_size_callback_(
+                batch_interval if batch_interval is not None else 0.05,
+                batch_size, batch_callback)
         self._quote_url_path = quote_url_path
         self._force_https = force_https
         self._cache_location = cache_location
@@ -66,16 +173,54 @@ class URLReader(object):
         self._wait_until_done = wait_until_done
 
         if self._use_cache:
+            if self._cache_location is None:
+                from .nsurlsession import cache_directory_url
+                self._cache_location = cache_directory_url()
             # cast the cache location to an NSURL if it’s a string
             if isinstance(self._cache_location, str):
+                from Foundation import NSURL
                 self._cache_location = \
                     NSURL.URLWithString_(self._cache_location)
             self._reader.setCacheAtDirectoryURL_(self._cache_location)
 
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release the underlying session and its connections
+
+        Fetches in progress still complete, but no new ones can start.
+        This also happens when the reader is garbage collected.
+        """
+        # __init__ might not have got as far as creating the reader
+        if getattr(self, '_reader', None) is None or self._closed:
+            return
+        self._closed = True
+        self._reader.invalidate()
+
     @property
     def done(self):
         return self._reader.done()
 
+    def timings_for_url(self, url):
+        """Resolver, connect and total timings of the last fetch of `url`
+
+        Returns a dict of durations in seconds, with None for the phases
+        that didn’t happen (e.g. the lookup of a reused connection), or
+        None if there are no timings for the URL. Only the timings of the
+        last 1000 URLs fetched are kept.
+        """
+        if url is None:
+            raise URLReaderError('URL must not be None')
+        url = self.process_url(url)
+        return self._reader.timingsForURL_(url)
+
     def quote_url_path(self, url):
         u = urlparse(url)
         if quote_r.search(u.path): # this path is already quoted
@@ -89,6 +234,8 @@ class URLReader(object):
         return url
 
     def process_url(self, url):
+        from Foundation import NSURL
+
         if isinstance(url, NSURL):
             url = str(url)
         if self._quote_url_path:
@@ -121,159 +268,60 @@ class URLReader(object):
             self._reader.flushCache()
 
     def continue_runloop(self):
+        from Foundation import NSRunLoop, NSDate
+
         NSRunLoop.mainRunLoop().runUntilDate_(
             NSDate.dateWithTimeIntervalSinceNow_(0.01))
 
-    def fetch(self, url, callback, invalidate_cache=False):
+    def fetch(self, url, callback, invalidate_cache=False,
+              timeout=None, response_timeout=None, body_timeout=None,
+              idle_timeout=None, tag=None):
+        """Fetch `url` in the background and pass it to `callback`
+
+        The timeouts, in seconds, override the ones the reader was
+        created with for this request only. `timeout` is the overall
+        deadline and can only be shorter than the reader’s. `tag` can be
+        any value, so fetches can be cancelled together with cancel_all().
+        `callback` can be None if the reader has a batch_callback.
+
+        Returns a URLReaderHandle. If `url` is already being fetched, the
+        new handle shares that request, and its timeouts, and the request
+        is only cancelled once all of its handles are.
+        """
         if url is None:
             raise URLReaderError('URL must not be None')
-        if callback is None:
+        if callback is None and self._batch_callback is None:
             raise URLReaderError('Callback must not be None')
+        if self._closed:
+            raise URLReaderError('URLReader is closed')
 
         url = self.process_url(url)
 
         if invalidate_cache:
             self.invalidate_cache_for_url(url)
 
-        self._reader.fetchURL_withCallback_(url, callback)
+        timeouts = {
+            'total': timeout,
+            'response': response_timeout
+            if response_timeout is not None else self._response_timeout,
+            'body': body_timeout
+            if body_timeout is not None else self._body_timeout,
+            'idle': idle_timeout,
+        }
+        handle = self._reader.fetchHandle_timeouts_(
+            URLReaderHandle(self, url, callback, tag), timeouts)
 
         if self._wait_until_done:
             while not self.done:
                 self.continue_runloop()
 
+        return handle
 
-class _URLReader(NSObject):
-
-    """A light wrapper around NSURLSession & related APIs"""
-
-    def init(self):
-        self = objc.super(_URLReader, self).init()
-        self._session = None
-        self._timeout = None
-        self._callbacks = {}
-        self._config = NSURLSessionConfiguration.defaultSessionConfiguration()
-        # this is only available in macOS 10.13+
-        if 'waitsForConnectivity' in dir(self._config):
-            self._config.setWaitsForConnectivity_(True)
-        self._cache = None
-        self._requestCachePolicy = NSURLRequestUseProtocolCachePolicy
-        return self
+    def cancel_all(self, tag=None):
+        """Cancel the fetches in progress, or only the ones with `tag`
 
-    def setupSession(self):
-        if self._timeout is not None:
-            self._config.setTimeoutIntervalForResource_(self._timeout)
-        if self._cache is not None:
-            self._config.setURLCache_(self._cache)
-            self._config.setRequestCachePolicy_(self._requestCachePolicy)
-        self._session = NSURLSession.sessionWithConfiguration_(self._config)
-
-    def setTimeout_(self, timeout):
-        self._timeout = timeout
-        self.setupSession()
-
-    def setCacheAtDirectoryURL_(self, url):
-        self._cache = NSURLCache.alloc()
-        memoryCapacity = 5 * 1024 * 1024
-        diskCapacity = 20 * 1024 * 1024
-
-        if 'initWithMemoryCapacity_diskCapacity_directoryURL_' in \
-                dir(self._cache):
-            self._cache.initWithMemoryCapacity_diskCapacity_directoryURL_(
-                memoryCapacity, diskCapacity, url)
-        else:
-            # this API will be deprecated in macOS 10.15 and
-            # replaced by the one above
-            self._cache.initWithMemoryCapacity_diskCapacity_diskPath_(
-                memoryCapacity, diskCapacity, url.relativePath())
-
-        self._requestCachePolicy = NSURLRequestReturnCacheDataElseLoad
-        self.setupSession()
-
-    def makeCachedResponseWithData_forURL_(self, data, url):
-        response = NSURLResponse.alloc().\
-            initWithURL_MIMEType_expectedContentLength_textEncodingName_(
-                url, 'application/octet-stream', len(data), 'utf-8'
-            )
-        return NSCachedURLResponse.alloc().\
-            initWithResponse_data_(response, data)
-
-    def getCachedDataForURL_(self, url):
-        if self._cache:
-            request = self.requestForURL_(url)
-            cached_response = self._cache.cachedResponseForRequest_(request)
-            if cached_response:
-                return cached_response.data()
-
-    def setCachedData_forURL_(self, data, url):
-        if self._cache:
-            response = self.makeCachedResponseWithData_forURL_(data, url)
-            request = self.requestForURL_(url)
-            self._cache.storeCachedResponse_forRequest_(response, request)
-
-    def invalidateCacheForURL_(self, url):
-        if self._cache:
-            request = self.requestForURL_(url)
-            self._cache.removeCachedResponseForRequest_(request)
-
-    def flushCache(self):
-        if self._cache:
-            self._cache.removeAllCachedResponses()
-        else:
-            NSURLCache.sharedURLCache().removeAllCachedResponses()
-
-    def requestForURL_(self, url):
-        return NSURLRequest.requestWithURL_cachePolicy_timeoutInterval_(
-            url, self._requestCachePolicy, self._timeout
-        )
-
-    def makeHandlerWithURL_(self, url):
-        def handler(data, response, error):
-            callback = self._callbacks[url]
-
-            # if there is no data we return the original URL
-            response_url = url
-
-            if data and response:
-
-                # save the URL returned after all the possible redirects
-                post_redirect_url = response.URL()
-
-                if self._cache:
-                    # always cache with the original request URL so even
-                    # if the response requires a redirect, like for raw
-                    # files on Github, we can still fulfill it offline
-                    self.setCachedData_forURL_(data, url)
-
-                    # but in that case, remove the cached data for the
-                    # final URL so we don’t store two copies
-                    if url != post_redirect_url:
-                        self.invalidateCacheForURL_(post_redirect_url)
-
-                # if we have a response we pass the final URL after
-                # the redirects, so a consumer can see it changed
-                response_url = post_redirect_url
-
-            # callAfter executes on the main thread
-            callAfter(callback, response_url, data, error)
-            del self._callbacks[url]
-        return handler
-
-    def fetchURL_withCallback_(self, url, callback):
-        cachedData = self.getCachedDataForURL_(url)
-        if cachedData:
-            # callAfter executes on the main thread
-            callAfter(callback, url, cachedData, None)
-            return
-
-        request = self.requestForURL_(url)
-        handler = self.makeHandlerWithURL_(url)
-        if url not in self._callbacks:
-            self._callbacks[url] = callback
-            task = self._session.\
-                dataTaskWithRequest_completionHandler_(request, handler)
-            task.resume()
-        else:
-            logger.error(f'{url} already being fetched')
-
-    def done(self):
-        return len(self._callbacks) == 0
+        Their callbacks won’t be called, even if their results are already
+        on their way to the main thread, and their connections are closed.
+        """
+        for handle in self._reader.handlesWithTag_(tag):
+            handle.cancel()
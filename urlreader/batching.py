@@ -0,0 +1,63 @@
+import threading
+
+from .watchdog import shared_watchdog
+
+
+class Batcher(object):
+    """Collect results and hand them over to the main thread together
+
+    Results added from any thread are passed in a list to `deliver`
+    through a single `dispatch(deliver, batch)` call (e.g. callAfter), at
+    most `interval` seconds after the first one of the batch was added,
+    or as soon as there are `size` of them.
+    """
+
+    def __init__(self, dispatch, deliver, interval=0.05, size=None,
+                 watchdog=None):
+        self._dispatch = dispatch
+        self._deliver = deliver
+        self._interval = interval
+        self._size = size
+        self._watchdog = watchdog or shared_watchdog()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+        # added but not delivered yet, including the batches in transit
+        self._undelivered = 0
+
+    def add(self, result):
+        with self._lock:
+            self._pending.append(result)
+            self._undelivered += 1
+            if self._size is None or len(self._pending) < self._size:
+                if self._timer is None:
+                    self._timer = self._watchdog.schedule(
+                        self._interval, self.flush)
+                return
+            batch = self._take()
+        self._dispatch(self._deliver_batch, batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._dispatch(self._deliver_batch, batch)
+
+    def idle(self):
+        """True when everything added so far has been delivered"""
+        with self._lock:
+            return self._undelivered == 0
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._watchdog.cancel(self._timer)
+            self._timer = None
+        return batch
+
+    def _deliver_batch(self, batch):
+        try:
+            self._deliver(batch)
+        finally:
+            with self._lock:
+                self._undelivered -= len(batch)
@@ -0,0 +1,437 @@
+import objc
+import logging
+import threading
+
+from collections import OrderedDict
+
+from Foundation import NSObject
+from Foundation import NSFileManager, NSCachesDirectory, NSUserDomainMask
+from Foundation import NSURLSession, NSURLSessionConfiguration
+from Foundation import NSURLRequest, NSURLRequestUseProtocolCachePolicy
+from Foundation import NSURLRequestReturnCacheDataElseLoad, NSURLCache
+from Foundation import NSURLResponse, NSCachedURLResponse
+from Foundation import NSError, NSURLErrorDomain, NSLocalizedDescriptionKey
+from Foundation import NSURLErrorCannotFindHost, NSURLErrorDNSLookupFailed
+from Foundation import NSURLErrorTimedOut, NSURLErrorCancelled
+from Foundation import NSURLSessionTaskStateRunning
+
+from PyObjCTools.AppHelper import callAfter
+
+from . import TIMEOUT_ERROR_KEY
+from .batching import Batcher
+from .watchdog import shared_watchdog
+
+
+logger = logging.getLogger('URLReader')
+
+
+TIMEOUT_DESCRIPTIONS = {
+    'response': 'The server took too long to respond.',
+    'body': 'The server took too long to send the response body.',
+    'total': 'The request took too long to complete.',
+}
+
+
+# how many URLs we keep the timings of, the least recently fetched go first
+TIMINGS_CAPACITY = 1000
+
+
+_cache_directory_urls = {}
+
+
+def user_cache_directory_url():
+    if 'user' not in _cache_directory_urls:
+        _cache_directory_urls['user'], _ = NSFileManager.defaultManager().\
+            URLForDirectory_inDomain_appropriateForURL_create_error_(
+                NSCachesDirectory, NSUserDomainMask, None, True, None
+            )
+    return _cache_directory_urls['user']
+
+
+def cache_directory_url():
+    if 'urlreader' not in _cache_directory_urls:
+        _cache_directory_urls['urlreader'] = user_cache_directory_url().\
+            URLByAppendingPathComponent_isDirectory_('URLReader', True)
+    return _cache_directory_urls['urlreader']
+
+
+class _Fetch(object):
+    """A task in progress and the handles waiting for it"""
+
+    def __init__(self, url):
+        self.url = url
+        self.task = None
+        self.handles = []
+        self.timers = []
+        self.timed_out = None
+
+
+class _URLReader(NSObject):
+
+    """A light wrapper around NSURLSession & related APIs"""
+
+    def init(self):
+        self = objc.super(_URLReader, self).init()
+        self._session = None
+        self._timeout = None
+        self._idleTimeout = None
+        # the completion handlers run on the session’s delegate queue
+        self._fetches = {}
+        # every handle until its callback runs or it’s cancelled, including
+        # the ones whose result is on its way to the main thread
+        self._outstanding = set()
+        self._fetchesLock = threading.Lock()
+        self._config = NSURLSessionConfiguration.defaultSessionConfiguration()
+        # this is only available in macOS 10.13+
+        if 'waitsForConnectivity' in dir(self._config):
+            self._config.setWaitsForConnectivity_(True)
+        self._cache = None
+        self._requestCachePolicy = NSURLRequestUseProtocolCachePolicy
+        self._dnsCache = None
+        self._batcher = None
+        self._batchCallback = None
+        self._timings = OrderedDict()
+        self._timingsLock = threading.Lock()
+        return self
+
+    def setupSession(self):
+        if self._timeout is not None:
+            self._config.setTimeoutIntervalForResource_(self._timeout)
+        if self._cache is not None:
+            self._config.setURLCache_(self._cache)
+            self._config.setRequestCachePolicy_(self._requestCachePolicy)
+        # the session retains its delegate until it’s invalidated
+        if self._session is not None:
+            self._session.finishTasksAndInvalidate()
+        # we are the delegate so we can collect the task metrics
+        self._session = NSURLSession.\
+            sessionWithConfiguration_delegate_delegateQueue_(
+                self._config, self, None)
+
+    def invalidate(self):
+        # let the tasks in progress finish, then release the session, its
+        # connections and its strong reference to us, the delegate
+        if self._session is not None:
+            self._session.finishTasksAndInvalidate()
+            self._session = None
+
+    def setTimeout_(self, timeout):
+        self._timeout = timeout
+        self.setupSession()
+
+    def setIdleTimeout_(self, timeout):
+        self._idleTimeout = timeout
+
+    def setBatchInterval_size_callback_(self, interval, size, callback):
+        def dispatch(deliver, batch):
+            # the batch window timer fires on the watchdog thread
+            with objc.autorelease_pool():
+                callAfter(deliver, batch)
+
+        self._batcher = Batcher(
+            dispatch, self.deliverBatch_, interval=interval, size=size)
+        self._batchCallback = callback
+
+    def deliverHandle_url_data_error_(self, handle, url, data, error):
+        if self._batcher is not None:
+            self._batcher.add((handle, url, data, error))
+        else:
+            # callAfter executes on the main thread
+            callAfter(handle._complete, url, data, error)
+
+    def deliverBatch_(self, batch):
+        # one main thread hop for the whole batch
+        results = []
+        for handle, url, data, error in batch:
+            try:
+                delivered = handle._complete(url, data, error)
+            except Exception:
+                # one bad callback mustn’t hold up the rest of the batch,
+                # and its handle has its result already
+                logger.exception(f'{url} callback failed')
+                delivered = True
+            if delivered:
+                results.append((url, data, error))
+        if self._batchCallback is not None and results:
+            self._batchCallback(results)
+
+    def setDNSCache_(self, dnsCache):
+        self._dnsCache = dnsCache
+
+    def setCacheAtDirectoryURL_(self, url):
+        self._cache = NSURLCache.alloc()
+        memoryCapacity = 5 * 1024 * 1024
+        diskCapacity = 20 * 1024 * 1024
+
+        if 'initWithMemoryCapacity_diskCapacity_directoryURL_' in \
+                dir(self._cache):
+            self._cache.initWithMemoryCapacity_diskCapacity_directoryURL_(
+                memoryCapacity, diskCapacity, url)
+        else:
+            # this API will be deprecated in macOS 10.15 and
+            # replaced by the one above
+            self._cache.initWithMemoryCapacity_diskCapacity_diskPath_(
+                memoryCapacity, diskCapacity, url.relativePath())
+
+        self._requestCachePolicy = NSURLRequestReturnCacheDataElseLoad
+        self.setupSession()
+
+    def makeCachedResponseWithData_forURL_(self, data, url):
+        response = NSURLResponse.alloc().\
+            initWithURL_MIMEType_expectedContentLength_textEncodingName_(
+                url, 'application/octet-stream', len(data), 'utf-8'
+            )
+        return NSCachedURLResponse.alloc().\
+            initWithResponse_data_(response, data)
+
+    def getCachedDataForURL_(self, url):
+        if self._cache:
+            request = self.requestForURL_(url)
+            cached_response = self._cache.cachedResponseForRequest_(request)
+            if cached_response:
+                return cached_response.data()
+
+    def setCachedData_forURL_(self, data, url):
+        if self._cache:
+            response = self.makeCachedResponseWithData_forURL_(data, url)
+            request = self.requestForURL_(url)
+            self._cache.storeCachedResponse_forRequest_(response, request)
+
+    def invalidateCacheForURL_(self, url):
+        if self._cache:
+            request = self.requestForURL_(url)
+            self._cache.removeCachedResponseForRequest_(request)
+
+    def flushCache(self):
+        if self._cache:
+            self._cache.removeAllCachedResponses()
+        else:
+            NSURLCache.sharedURLCache().removeAllCachedResponses()
+
+    def requestForURL_(self, url):
+        return self.requestForURL_timeoutInterval_(url, None)
+
+    def requestForURL_timeoutInterval_(self, url, timeoutInterval):
+        # the request timeout is how long the task can stay idle, which
+        # also covers the connection attempt, so it falls back to the
+        # overall timeout unless an idle timeout is set
+        if timeoutInterval is None:
+            timeoutInterval = self._idleTimeout \
+                if self._idleTimeout is not None else self._timeout
+        return NSURLRequest.requestWithURL_cachePolicy_timeoutInterval_(
+            url, self._requestCachePolicy, timeoutInterval
+        )
+
+    def makeTimeoutErrorForURL_phase_(self, url, phase):
+        return NSError.errorWithDomain_code_userInfo_(
+            NSURLErrorDomain, NSURLErrorTimedOut, {
+                NSLocalizedDescriptionKey: TIMEOUT_DESCRIPTIONS[phase],
+                'NSErrorFailingURLKey': url,
+                TIMEOUT_ERROR_KEY: phase,
+            })
+
+    def watchFetch_timeouts_(self, fetch, timeouts):
+        # NSURLSession only knows about idle and resource timeouts, so
+        # the other ones cancel the task, which also releases its socket.
+        # It doesn’t tell when a running task is connected either, so the
+        # connection attempt is covered by the idle timeout instead.
+        task = fetch.task
+        checks = (
+            ('response', lambda: task.response() is None),
+            ('body', lambda: task.countOfBytesReceived() == 0),
+            ('total', lambda: True),
+        )
+
+        def expire(phase, stalled):
+            with objc.autorelease_pool():
+                if task.state() == NSURLSessionTaskStateRunning and \
+                        stalled():
+                    fetch.timed_out = phase
+                    task.cancel()
+
+        watchdog = shared_watchdog()
+        for phase, stalled in checks:
+            if timeouts.get(phase) is not None:
+                fetch.timers.append(
+                    watchdog.schedule(timeouts[phase], expire, phase, stalled))
+
+    def unwatchFetch_(self, fetch):
+        watchdog = shared_watchdog()
+        for timer in fetch.timers:
+            watchdog.cancel(timer)
+        fetch.timers = []
+
+    def timingsForURL_(self, url):
+        with self._timingsLock:
+            return self._timings.get(str(url))
+
+    def URLSession_task_didFinishCollectingMetrics_(
+            self, session, task, metrics):
+        # this is only available in macOS 10.12+
+        def interval(start, end):
+            if start is None or end is None:
+                return None
+            return end.timeIntervalSinceDate_(start)
+
+        transactions = metrics.transactionMetrics()
+        if not transactions:
+            return
+        # the last transaction is the one that fetched the final response
+        t = transactions[-1]
+        timings = {
+            'domain_lookup': interval(
+                t.domainLookupStartDate(), t.domainLookupEndDate()),
+            'connect': interval(t.connectStartDate(), t.connectEndDate()),
+            'secure_connection': interval(
+                t.secureConnectionStartDate(), t.secureConnectionEndDate()),
+            'first_byte': interval(
+                t.requestStartDate(), t.responseStartDate()),
+            'total': metrics.taskInterval().duration(),
+        }
+        key = str(task.originalRequest().URL())
+        with self._timingsLock:
+            self._timings.pop(key, None)
+            self._timings[key] = timings
+            while len(self._timings) > TIMINGS_CAPACITY:
+                self._timings.popitem(last=False)
+
+    def makeHostNotFoundErrorForURL_(self, url):
+        return NSError.errorWithDomain_code_userInfo_(
+            NSURLErrorDomain, NSURLErrorCannotFindHost, {
+                NSLocalizedDescriptionKey:
+                    'A server with the specified hostname could not be found.',
+                'NSErrorFailingURLKey': url,
+            })
+
+    def makeHandlerWithFetch_(self, fetch):
+        url = fetch.url
+
+        def handler(data, response, error):
+            self.unwatchFetch_(fetch)
+
+            with self._fetchesLock:
+                if self._fetches.get(url) is not fetch:
+                    # every handle was cancelled, nobody is waiting for it
+                    return
+
+            phase = fetch.timed_out
+            if phase is not None and error is not None and \
+                    error.code() == NSURLErrorCancelled:
+                # the watchdog cancelled the task
+                error = self.makeTimeoutErrorForURL_phase_(url, phase)
+
+            if self._dnsCache is not None and error is not None and \
+                    error.domain() == NSURLErrorDomain and error.code() in (
+                        NSURLErrorCannotFindHost, NSURLErrorDNSLookupFailed):
+                # remember the failure so the next URLs on this host
+                # fail right away instead of going through the resolver,
+                # but it might be a redirect that failed, not our host
+                failingURL = error.userInfo().get('NSErrorFailingURLKey')
+                if failingURL is None:
+                    failingURL = url
+                if failingURL.host():
+                    self._dnsCache.set_failure(str(failingURL.host()))
+
+            # if there is no data we return the original URL
+            response_url = url
+
+            if data and response:
+
+                # save the URL returned after all the possible redirects
+                post_redirect_url = response.URL()
+
+                if self._cache:
+                    # always cache with the original request URL so even
+                    # if the response requires a redirect, like for raw
+                    # files on Github, we can still fulfill it offline
+                    self.setCachedData_forURL_(data, url)
+
+                    # but in that case, remove the cached data for the
+                    # final URL so we don’t store two copies
+                    if url != post_redirect_url:
+                        self.invalidateCacheForURL_(post_redirect_url)
+
+                # if we have a response we pass the final URL after
+                # the redirects, so a consumer can see it changed
+                response_url = post_redirect_url
+
+            with self._fetchesLock:
+                # it might have been cancelled in the meantime
+                if self._fetches.get(url) is not fetch:
+                    return
+                for handle in fetch.handles:
+                    self.deliverHandle_url_data_error_(
+                        handle, response_url, data, error)
+                del self._fetches[url]
+        return handler
+
+    def fetchHandle_timeouts_(self, handle, timeouts):
+        url = handle.url
+        if timeouts is None:
+            timeouts = {}
+
+        with self._fetchesLock:
+            self._outstanding.add(handle)
+
+        cachedData = self.getCachedDataForURL_(url)
+        if cachedData:
+            self.deliverHandle_url_data_error_(handle, url, cachedData, None)
+            return handle
+
+        if self._dnsCache is not None and url.host() and \
+                self._dnsCache.is_unresolvable(str(url.host())):
+            error = self.makeHostNotFoundErrorForURL_(url)
+            self.deliverHandle_url_data_error_(handle, url, None, error)
+            return handle
+
+        with self._fetchesLock:
+            fetch = self._fetches.get(url)
+            if fetch is not None:
+                # share the task in progress, with its timeouts
+                fetch.handles.append(handle)
+                handle._task = fetch.task
+                return handle
+
+            fetch = _Fetch(url)
+            fetch.handles.append(handle)
+            request = self.requestForURL_timeoutInterval_(
+                url, timeouts.get('idle'))
+            handler = self.makeHandlerWithFetch_(fetch)
+            fetch.task = self._session.\
+                dataTaskWithRequest_completionHandler_(request, handler)
+            handle._task = fetch.task
+            self.watchFetch_timeouts_(fetch, timeouts)
+            self._fetches[url] = fetch
+        fetch.task.resume()
+        return handle
+
+    def forgetHandle_(self, handle):
+        with self._fetchesLock:
+            self._outstanding.discard(handle)
+
+    def cancelHandle_(self, handle):
+        with self._fetchesLock:
+            self._outstanding.discard(handle)
+            fetch = self._fetches.get(handle.url)
+            if fetch is None or handle not in fetch.handles:
+                return
+            fetch.handles.remove(handle)
+            if fetch.handles:
+                # someone else is still waiting for it
+                return
+            del self._fetches[handle.url]
+        self.unwatchFetch_(fetch)
+        fetch.task.cancel()
+
+    def handlesWithTag_(self, tag):
+        with self._fetchesLock:
+            return [h for h in self._outstanding
+                    if tag is None or h.tag == tag]
+
+    def done(self):
+        # the handler adds to the batcher and drops the fetch under this
+        # lock, so both have to be checked under it as well
+        with self._fetchesLock:
+            if self._batcher is not None and not self._batcher.idle():
+                return False
+            return len(self._fetches) == 0
@@ -0,0 +1,44 @@
+import time
+import threading
+
+
+class DNSCache(object):
+    """An in-process negative DNS cache
+
+    URLReader records the hosts NSURLSession failed to resolve, which are
+    kept for `negative_ttl` seconds, and fails later URLs on them right
+    away instead of going through the resolver every single time. The
+    hosts that do resolve are left to NSURLSession and the system
+    resolver cache. The same DNSCache can be shared between readers.
+    """
+
+    def __init__(self, negative_ttl=10, clock=time.monotonic):
+        self._negative_ttl = negative_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # host -> when its failure expires
+        self._failures = {}
+
+    def set_failure(self, host):
+        """Remember that `host` could not be resolved"""
+        with self._lock:
+            self._failures[host] = self._clock() + self._negative_ttl
+
+    def is_unresolvable(self, host):
+        """True if `host` failed to resolve less than negative_ttl ago"""
+        with self._lock:
+            expires = self._failures.get(host)
+            if expires is None:
+                return False
+            if self._clock() >= expires:
+                del self._failures[host]
+                return False
+            return True
+
+    def invalidate(self, host=None):
+        """Forget the failure of `host`, or of every host"""
+        with self._lock:
+            if host is None:
+                self._failures.clear()
+            else:
+                self._failures.pop(host, None)
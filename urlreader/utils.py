@@ -1,7 +1,5 @@
 from urllib.parse import urlparse
 
-from Foundation import NSString, NSUTF8StringEncoding
-
 
 def callback(url, data, error):
     if error is not None:
@@ -11,4 +9,6 @@ def callback(url, data, error):
 
 
 def decode_data(data):
+    from Foundation import NSString, NSUTF8StringEncoding
+
     return NSString.alloc().initWithData_encoding_(data, NSUTF8StringEncoding)
@@ -0,0 +1,74 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+
+logger = logging.getLogger('URLReader')
+
+
+class Watchdog(object):
+    """Run callbacks after a delay on a single background thread
+
+    Used to enforce the timeouts NSURLSession doesn’t support natively.
+    One thread serves every scheduled callback, so a large batch of
+    requests doesn’t start one timer thread per request. Callbacks must
+    be quick and must not block.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, function, *args):
+        """Call `function(*args)` in `delay` seconds
+
+        Returns a timer that can be passed to cancel().
+        """
+        timer = [self._clock() + delay, next(self._counter), function, args]
+        with self._condition:
+            heapq.heappush(self._heap, timer)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='URLReader watchdog', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return timer
+
+    def cancel(self, timer):
+        with self._condition:
+            # cancelled timers are skipped when they come up, and until
+            # then they mustn't keep their arguments (e.g. a task) alive
+            timer[2] = None
+            timer[3] = ()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > self._clock():
+                    wait = self._heap[0][0] - self._clock() \
+                        if self._heap else None
+                    self._condition.wait(wait)
+                _, _, function, args = heapq.heappop(self._heap)
+            if function is None:
+                continue
+            try:
+                function(*args)
+            except Exception:
+                logger.exception('watchdog callback failed')
+
+
+_watchdog = None
+_watchdog_lock = threading.Lock()
+
+
+def shared_watchdog():
+    global _watchdog
+    with _watchdog_lock:
+        if _watchdog is None:
+            _watchdog = Watchdog()
+        return _watchdog